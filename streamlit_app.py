@@ -1,10 +1,20 @@
 import os
 import glob
+import hashlib
+import json
+import shutil
+import tempfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import matplotlib.pyplot as plt
+import numexpr as ne
+from matplotlib.cm import ScalarMappable
+from matplotlib.colors import Normalize
+from matplotlib.figure import Figure
 import pydicom
 import streamlit as st
-from scipy.ndimage import zoom, rotate
+from PIL import Image
+from scipy.ndimage import zoom
 
 # Streamlit app title
 st.title("DICOM CT Slices and RT Files Uploader with Independent Slice Scrolling")
@@ -14,6 +24,9 @@ temp_dir = "temp_dicom"
 if not os.path.exists(temp_dir):
     os.makedirs(temp_dir)
 
+# Thread count for DICOM reads and writes, which are I/O-bound
+max_io_workers = min(32, (os.cpu_count() or 1) * 4)
+
 # Drag and drop file uploader
 uploaded_files = st.file_uploader(
     "Upload DICOM CT Slices, RT Dose, RT Structure, and RT Plan files",
@@ -21,71 +34,300 @@ uploaded_files = st.file_uploader(
     accept_multiple_files=True
 )
 
+# Function to check whether a file on disk already holds exactly the uploaded bytes
+def has_same_contents(uploaded_file, file_path):
+    if not os.path.exists(file_path) or os.path.getsize(file_path) != uploaded_file.size:
+        return False
+    uploaded_file.seek(0)
+    with open(file_path, "rb") as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if chunk != uploaded_file.read(1 << 20):
+                return False
+            if not chunk:
+                return True
+
+# Function to save an uploaded file to the temp folder
+def save_uploaded_file(uploaded_file):
+    file_path = os.path.join(temp_dir, uploaded_file.name)
+    # Leave identical files untouched so their mtime, and with it the persisted CT
+    # volume, stays valid when the same files are uploaded again in a new session
+    if has_same_contents(uploaded_file, file_path):
+        return
+    # Stream in 1 MiB chunks rather than materializing the whole upload
+    uploaded_file.seek(0)
+    with open(file_path, "wb") as f:
+        shutil.copyfileobj(uploaded_file, f, length=1 << 20)
+
 # Save uploaded files to the temp folder
 if uploaded_files:
-    for uploaded_file in uploaded_files:
-        file_name = uploaded_file.name
-        file_path = os.path.join(temp_dir, file_name)
-        with open(file_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
+    # Only write uploads not saved on a previous rerun, so their mtime, and with it
+    # the cached CT volume, stays valid while the sliders are moved
+    saved_upload_ids = st.session_state.setdefault("saved_upload_ids", set())
+    new_files = [f for f in uploaded_files if f.file_id not in saved_upload_ids]
+    with ThreadPoolExecutor(max_workers=max_io_workers) as executor:
+        list(executor.map(save_uploaded_file, new_files))
+    saved_upload_ids.update(f.file_id for f in new_files)
 
     st.success(f"Uploaded {len(uploaded_files)} files successfully!")
 
-# Function to load DICOM CT slices
-def load_ct_slices(temp_dir):
-    dicom_files = glob.glob(os.path.join(temp_dir, "*.dcm"))
-    slices = [pydicom.dcmread(fname) for fname in dicom_files if hasattr(pydicom.dcmread(fname), "SliceLocation")]
-    
-    if not slices:
-        st.error("No valid CT slices found.")
-        return None, None
+# Function to build a cheap cache key (path, size, mtime) for a file
+def file_signature(file_path):
+    stat = os.stat(file_path)
+    return (file_path, stat.st_size, stat.st_mtime)
+
+# Function to build the cache key for the candidate CT files in the temp folder,
+# skipping RT files by name so large RT Dose grids are never parsed as CT
+def ct_file_signatures(temp_dir):
+    return tuple(
+        file_signature(fname)
+        for fname in sorted(glob.glob(os.path.join(temp_dir, "*.dcm")))
+        if not any(rt_type in os.path.basename(fname).upper() for rt_type in ("RTDOSE", "RTPLAN", "RTSTRUCT"))
+    )
+
+# Function to load a CT volume persisted by an earlier run, if it was built from the same files
+def load_persisted_volume(temp_dir, inputs_hash):
+    # Any missing, truncated or mismatched file means the volume is rebuilt from the DICOM
+    try:
+        with open(os.path.join(temp_dir, "volume.json")) as f:
+            volume_info = json.load(f)
+        volume_file = f"volume-{inputs_hash}.npy"
+        if volume_info.get("inputs_hash") != inputs_hash or volume_info.get("volume_file") != volume_file:
+            return None
+
+        # Memory-map so slices are served from the page cache without decoding any DICOM
+        img3d = np.load(os.path.join(temp_dir, volume_file), mmap_mode="r")
+        if list(img3d.shape) != volume_info["shape"] or str(img3d.dtype) != volume_info["dtype"]:
+            return None
+        return img3d, tuple(volume_info["aspects"]), tuple(volume_info["window"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+# Function to write a file next to its final path and move it into place in one step,
+# so readers, including processes with the old file memory-mapped, never see a partial file
+def replace_file(file_path, write):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+# Function to persist a CT volume and its display info next to the source files
+def persist_volume(temp_dir, inputs_hash, img3d, aspects, window):
+    # Name the data file after the inputs hash, so a description written by a concurrent
+    # rebuild can never be paired with another session's volume
+    volume_file = f"volume-{inputs_hash}.npy"
+    volume_info = {
+        "inputs_hash": inputs_hash,
+        "volume_file": volume_file,
+        "shape": list(img3d.shape),
+        "dtype": str(img3d.dtype),
+        "aspects": [float(aspect) for aspect in aspects],
+        "window": list(window)
+    }
+    replace_file(os.path.join(temp_dir, volume_file), lambda f: np.save(f, img3d))
+    replace_file(os.path.join(temp_dir, "volume.json"), lambda f: f.write(json.dumps(volume_info).encode()))
+
+    # Drop volumes persisted for earlier inputs; processes that still map one keep reading it
+    for stale_file in glob.glob(os.path.join(temp_dir, "volume-*.npy")):
+        if os.path.basename(stale_file) != volume_file:
+            os.remove(stale_file)
+
+# Function to get a slice's position along the head-pointing normal of its image plane, falling back to SliceLocation
+def slice_position(header):
+    if "ImagePositionPatient" in header and "ImageOrientationPatient" in header:
+        orientation = np.array(header.ImageOrientationPatient, dtype=float)
+        normal = np.cross(orientation[:3], orientation[3:])
+        # Point the normal towards the head so index order always runs inferior to superior;
+        # feet-first scans (e.g. IOP [-1, 0, 0, 0, 1, 0]) otherwise come out reversed
+        if normal[2] < 0:
+            normal = -normal
+        return float(np.dot(normal, np.array(header.ImagePositionPatient, dtype=float)))
+    return float(header.SliceLocation)
+
+# Function to load DICOM CT slices, cached across reruns on the file signatures
+@st.cache_data(max_entries=1)
+def load_ct_slices(temp_dir, file_signatures):
+    inputs_hash = hashlib.sha256(repr(file_signatures).encode()).hexdigest()
+    persisted = load_persisted_volume(temp_dir, inputs_hash)
+    if persisted is not None:
+        return persisted
+
+    dicom_files = [fname for fname, _, _ in file_signatures]
+
+    def read_header(fname):
+        return pydicom.dcmread(
+            fname,
+            stop_before_pixels=True,
+            specific_tags=[
+                "SliceLocation", "PixelSpacing", "SliceThickness", "InstanceNumber",
+                "SeriesInstanceUID", "ImagePositionPatient", "ImageOrientationPatient"
+            ]
+        )
 
-    slices.sort(key=lambda s: s.SliceLocation)
-    ps = slices[0].PixelSpacing
-    ss = slices[0].SliceThickness
+    def read_pixels(fname):
+        return pydicom.dcmread(fname).pixel_array
+
+    # Triage and sort on headers only, then decode pixel data for the kept slices in order
+    with ThreadPoolExecutor(max_workers=max_io_workers) as executor:
+        # SliceLocation is optional, so a geometric position alone also marks a slice
+        headers = [
+            h for h in executor.map(read_header, dicom_files)
+            if ("ImagePositionPatient" in h and "ImageOrientationPatient" in h) or "SliceLocation" in h
+        ]
+        # Keep the largest series so slices of another scan are never stacked into the volume
+        if headers:
+            series_uid = Counter(h.get("SeriesInstanceUID") for h in headers).most_common(1)[0][0]
+            headers = [h for h in headers if h.get("SeriesInstanceUID") == series_uid]
+        headers.sort(key=lambda h: (slice_position(h), h.get("InstanceNumber") or 0))
+        planes = list(executor.map(read_pixels, [h.filename for h in headers]))
+
+    if not planes:
+        return None, None, None
+
+    ps = headers[0].PixelSpacing
+    ss = headers[0].SliceThickness
     ax_aspect = ps[1] / ps[0]
     sag_aspect = ss / ps[0]
     cor_aspect = ss / ps[0]
 
-    img_shape = list(slices[0].pixel_array.shape) + [len(slices)]
-    img3d = np.zeros(img_shape)
-
-    for i, s in enumerate(slices):
-        img3d[:, :, i] = s.pixel_array
-
-    return img3d, (ax_aspect, sag_aspect, cor_aspect)
+    # Slice-major (Z, Y, X) layout so each axial slice is contiguous
+    img3d = np.stack(planes, axis=0)
+    # Only the volume is needed from here on; free the per-slice copies before the
+    # percentile pass below allocates its own
+    del headers, planes
+
+    # Display window shared by every plane, computed once per volume; the 1st-99th
+    # percentiles keep outliers such as metal or padding from washing out the contrast
+    lo, hi = np.percentile(img3d, [1, 99])
+    window = (float(lo), float(hi))
+
+    # Persisting is only an optimization; a full or read-only disk must not fail the page
+    try:
+        persist_volume(temp_dir, inputs_hash, img3d, (ax_aspect, sag_aspect, cor_aspect), window)
+    except OSError:
+        pass
+
+    return img3d, (ax_aspect, sag_aspect, cor_aspect), window
+
+# Function to scale a CT plane to uint8 using the volume's display window
+def to_uint8(plane, window):
+    lo, hi = window
+    scale = 255.0 / max(hi - lo, 1.0)
+    # One float32 copy of the (possibly flipped) view, then scale it in place
+    scaled = plane.astype(np.float32)
+    scaled -= lo
+    scaled *= scale
+    np.clip(scaled, 0, 255, out=scaled)
+    return scaled.astype(np.uint8)
+
+# Function to resize a uint8 plane so its pixels are displayed with the given aspect ratio
+def resize_to_aspect(plane_u8, aspect):
+    height, width = plane_u8.shape
+    new_height = round(height * aspect)
+    # Square pixels (usually the axial plane) need no resample
+    if new_height == height:
+        return plane_u8
+    # Pillow's bilinear resize uses SSE4/AVX2 paths when Pillow-SIMD is installed
+    return np.asarray(Image.fromarray(plane_u8).resize((width, new_height), Image.BILINEAR))
 
 # Function to display slices
-def display_ct_slices(img3d, aspects):
-    axial_slider = st.slider("Select Axial Slice", 0, img3d.shape[2] - 1, img3d.shape[2] // 2)
-    sagittal_slider = st.slider("Select Sagittal Slice", 0, img3d.shape[0] - 1, img3d.shape[0] // 2)
+def display_ct_slices(img3d, aspects, window):
+    axial_slider = st.slider("Select Axial Slice", 0, img3d.shape[0] - 1, img3d.shape[0] // 2)
+    sagittal_slider = st.slider("Select Sagittal Slice", 0, img3d.shape[2] - 1, img3d.shape[2] // 2)
     coronal_slider = st.slider("Select Coronal Slice", 0, img3d.shape[1] - 1, img3d.shape[1] // 2)
 
-    fig, axes = plt.subplots(1, 3, figsize=(15, 5))
-
-    axes[0].imshow(img3d[:, :, axial_slider], cmap='gray')
-    axes[0].set_aspect(aspects[0])
-    axes[0].set_title(f"Axial Slice {axial_slider+1}/{img3d.shape[2]}")
-
-    sagittal_view = np.rot90(img3d[sagittal_slider, :, :])
-    axes[1].imshow(sagittal_view, cmap='gray')
-    axes[1].set_aspect(aspects[1])
-    axes[1].set_title(f"Sagittal Slice {sagittal_slider+1}/{img3d.shape[0]}")
+    # Send uint8 planes straight to st.image instead of rendering a matplotlib figure
+    axial_view = resize_to_aspect(to_uint8(img3d[axial_slider], window), aspects[0])
+    # Flip so the most superior slice is at the top
+    sagittal_view = resize_to_aspect(to_uint8(np.flipud(img3d[:, :, sagittal_slider]), window), aspects[1])
+    coronal_view = resize_to_aspect(to_uint8(np.flipud(img3d[:, coronal_slider, :]), window), aspects[2])
+
+    # Fuse the views into one mosaic, centred vertically, so only one image is encoded and sent
+    views = [axial_view, sagittal_view, coronal_view]
+    height = max(view.shape[0] for view in views)
+    mosaic = np.concatenate([
+        np.pad(view, (((height - view.shape[0]) // 2, (height - view.shape[0] + 1) // 2), (0, 0)))
+        for view in views
+    ], axis=1)
+    st.image(
+        mosaic,
+        caption=(
+            f"Axial Slice {axial_slider+1}/{img3d.shape[0]} | "
+            f"Sagittal Slice {sagittal_slider+1}/{img3d.shape[2]} | "
+            f"Coronal Slice {coronal_slider+1}/{img3d.shape[1]}"
+        ),
+        width="stretch"
+    )
 
-    coronal_view = np.rot90(img3d[:, coronal_slider, :])
-    axes[2].imshow(coronal_view, cmap='gray')
-    axes[2].set_aspect(aspects[2])
-    axes[2].set_title(f"Coronal Slice {coronal_slider+1}/{img3d.shape[1]}")
-
-    for ax in axes:
-        ax.axis('off')
+    return axial_slider, sagittal_slider, coronal_slider
 
-    st.pyplot(fig)
+# Function to load the RT Dose grid in Gy and its dose range, cached across reruns
+@st.cache_data(max_entries=1)
+def load_rt_dose(rt_dose_signature):
+    dose_ds = pydicom.dcmread(rt_dose_signature[0])
+    dose_array = dose_ds.pixel_array.astype(np.float32)
+    dose_array *= np.float32(dose_ds.DoseGridScaling)
+    return dose_array, (float(dose_array.min()), float(dose_array.max()))
+
+# Function to sample a single CT-resolution plane of the dose grid with trilinear interpolation
+def sample_dose_plane(dose_array, ct_shape, axis, index):
+    # Blend the two dose planes bracketing the CT plane, aligning the corner voxels
+    n, d = ct_shape[axis], dose_array.shape[axis]
+    position = index * (d - 1) / (n - 1) if n > 1 else 0.0
+    lower = int(position)
+    upper = min(lower + 1, d - 1)
+    weight = position - lower
+    dose_planes = np.moveaxis(dose_array, axis, 0)
+    plane = (1 - weight) * dose_planes[lower] + weight * dose_planes[upper]
+
+    # Then rescale just that plane in 2D to the CT plane shape
+    out_shape = [s for i, s in enumerate(ct_shape) if i != axis]
+    return zoom(plane, (
+        out_shape[0] / plane.shape[0],
+        out_shape[1] / plane.shape[1]
+    ), order=1, mode="nearest", prefilter=False)
+
+# Function to normalize a dose plane to [0, 1] over the dose range of the whole grid
+def normalize_dose_plane(dose_plane, dose_range):
+    lo, hi = dose_range
+    return ne.evaluate(
+        "where(d <= lo, 0, where(d >= hi, 1, (d - lo) * scale))",
+        local_dict={
+            "d": dose_plane,
+            "lo": np.float32(lo),
+            "hi": np.float32(hi),
+            "scale": np.float32(1.0 / max(hi - lo, 1e-6))
+        }
+    )
+
+# Function to get the dose overlay figure, built once per volume and reused across reruns
+def get_dose_overlay_figure(ct_slices, dose_slices, aspects, window, dose_range):
+    key = (tuple(ct_slice.shape for ct_slice in ct_slices), aspects, window, dose_range)
+    overlay = st.session_state.get("dose_overlay")
+    if overlay is None or overlay["key"] != key:
+        # A plain Figure owned by this session, so nothing is registered with pyplot
+        fig = Figure(figsize=(15, 5))
+        axes = fig.subplots(1, 3)
+        ct_images, dose_images = [], []
+        for ax, ct_slice, dose_slice, aspect in zip(axes, ct_slices, dose_slices, aspects):
+            ct_images.append(ax.imshow(ct_slice, cmap='gray', vmin=window[0], vmax=window[1]))
+            dose_images.append(ax.imshow(dose_slice, cmap='jet', alpha=0.5, vmin=0, vmax=1))
+            ax.set_aspect(aspect)
+            # The overlay holds normalized dose, so label the colorbar with the dose range in Gy
+            fig.colorbar(ScalarMappable(Normalize(*dose_range), cmap='jet'), ax=ax, alpha=0.5, label="Dose (Gy)")
+            # Remove axes labels
+            ax.axis('off')
 
-    return axial_slider, sagittal_slider, coronal_slider
+        overlay = {"key": key, "fig": fig, "axes": axes, "ct_images": ct_images, "dose_images": dose_images}
+        st.session_state.dose_overlay = overlay
+    return overlay
 
 # Function to overlay RT Dose on the CT slices
-def overlay_rt_dose_on_ct(temp_dir, img3d, axial_slider, sagittal_slider, coronal_slider, ax_aspect, sag_aspect, cor_aspect):
+def overlay_rt_dose_on_ct(temp_dir, img3d, axial_slider, sagittal_slider, coronal_slider, ax_aspect, sag_aspect, cor_aspect, window):
     rt_dose_file = None
     # Find RT Dose file in the temp directory
     for file_name in os.listdir(temp_dir):
@@ -94,51 +336,36 @@ def overlay_rt_dose_on_ct(temp_dir, img3d, axial_slider, sagittal_slider, corona
             break
 
     if rt_dose_file:
-        # Read the RT Dose DICOM file
-        dose_ds = pydicom.dcmread(rt_dose_file)
-
-        # Rescale the RT Dose grid to match the CT image shape
-        dose_array = dose_ds.pixel_array.astype(np.float32)
-        dose_rescaled = zoom(dose_array, (
-            img3d.shape[0] / dose_array.shape[0],
-            img3d.shape[1] / dose_array.shape[1],
-            img3d.shape[2] / dose_array.shape[2]
-        ))
-
-        # Rotate dose slices for proper alignment with the CT slices
-        axial_dose_slice = dose_rescaled[:, :, axial_slider]
-        sagittal_dose_slice = rotate(dose_rescaled[sagittal_slider, :, :], 90, reshape=False)
-        coronal_dose_slice = rotate(dose_rescaled[:, coronal_slider, :], 90, reshape=False)
-
-        # Plot CT slices with dose overlay
-        fig, axes = plt.subplots(1, 3, figsize=(15, 5))
-
-        # Axial slice with dose overlay
-        axes[0].imshow(img3d[:, :, axial_slider], cmap='gray')
-        dose_overlay_axial = axes[0].imshow(axial_dose_slice, cmap='jet', alpha=0.5)
-        axes[0].set_aspect(ax_aspect)
-        axes[0].set_title(f"Axial Slice {axial_slider+1}")
-        plt.colorbar(dose_overlay_axial, ax=axes[0], label="Dose (Gy)")
-
-        # Sagittal slice with dose overlay
-        axes[1].imshow(np.rot90(img3d[sagittal_slider, :, :]), cmap='gray')
-        dose_overlay_sagittal = axes[1].imshow(sagittal_dose_slice, cmap='jet', alpha=0.5)
-        axes[1].set_aspect(sag_aspect)
-        axes[1].set_title(f"Sagittal Slice {sagittal_slider+1}")
-        plt.colorbar(dose_overlay_sagittal, ax=axes[1], label="Dose (Gy)")
-
-        # Coronal slice with dose overlay
-        axes[2].imshow(np.rot90(img3d[:, coronal_slider, :]), cmap='gray')
-        dose_overlay_coronal = axes[2].imshow(coronal_dose_slice, cmap='jet', alpha=0.5)
-        axes[2].set_aspect(cor_aspect)
-        axes[2].set_title(f"Coronal Slice {coronal_slider+1}")
-        plt.colorbar(dose_overlay_coronal, ax=axes[2], label="Dose (Gy)")
-
-        # Remove axes labels
-        for ax in axes:
-            ax.axis('off')
-
-        st.pyplot(fig)
+        # Read the RT Dose grid and resample only the displayed planes to the CT shape
+        dose_array, dose_range = load_rt_dose(file_signature(rt_dose_file))
+
+        # Axial, sagittal and coronal CT slices; the dose grid shares the CT (Z, Y, X)
+        # layout, so its planes are flipped the same way
+        ct_slices = [
+            img3d[axial_slider],
+            np.flipud(img3d[:, :, sagittal_slider]),
+            np.flipud(img3d[:, coronal_slider, :])
+        ]
+        dose_slices = [
+            sample_dose_plane(dose_array, img3d.shape, 0, axial_slider),
+            np.flipud(sample_dose_plane(dose_array, img3d.shape, 2, sagittal_slider)),
+            np.flipud(sample_dose_plane(dose_array, img3d.shape, 1, coronal_slider))
+        ]
+        dose_slices = [normalize_dose_plane(dose_slice, dose_range) for dose_slice in dose_slices]
+        titles = [
+            f"Axial Slice {axial_slider+1}",
+            f"Sagittal Slice {sagittal_slider+1}",
+            f"Coronal Slice {coronal_slider+1}"
+        ]
+
+        # Plot CT slices with dose overlay, only swapping the image data on reruns
+        overlay = get_dose_overlay_figure(ct_slices, dose_slices, (ax_aspect, sag_aspect, cor_aspect), window, dose_range)
+        for i in range(3):
+            overlay["ct_images"][i].set_data(ct_slices[i])
+            overlay["dose_images"][i].set_data(dose_slices[i])
+            overlay["axes"][i].set_title(titles[i])
+
+        st.pyplot(overlay["fig"])
     else:
         st.error("RT Dose file not found.")
 
@@ -163,8 +390,8 @@ def load_rt_plan_and_extract_tags(temp_dir):
             break
 
     if rt_plan_file:
-        # Read the RT Plan DICOM file
-        ds = pydicom.dcmread(rt_plan_file)
+        # Read only the beam information from the RT Plan DICOM file
+        ds = pydicom.dcmread(rt_plan_file, stop_before_pixels=True, specific_tags=["BeamSequence"])
 
         # Display the beam information
         beam_info = list_beams(ds)
@@ -175,10 +402,12 @@ def load_rt_plan_and_extract_tags(temp_dir):
 
 # Main processing and display of CT slices
 if uploaded_files:
-    img3d, aspects = load_ct_slices(temp_dir)
-    if img3d is not None:
-        slices = display_ct_slices(img3d, aspects)
-        overlay_rt_dose_on_ct(temp_dir, img3d, slices[0], slices[1], slices[2], aspects[0], aspects[1], aspects[2])
+    img3d, aspects, window = load_ct_slices(temp_dir, ct_file_signatures(temp_dir))
+    if img3d is None:
+        st.error("No valid CT slices found.")
+    else:
+        slices = display_ct_slices(img3d, aspects, window)
+        overlay_rt_dose_on_ct(temp_dir, img3d, slices[0], slices[1], slices[2], aspects[0], aspects[1], aspects[2], window)
         load_rt_plan_and_extract_tags(temp_dir)
 else:
     st.info("Please upload DICOM CT slices, RT Dose, RT Structure, and RT Plan files.")